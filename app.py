@@ -3,12 +3,73 @@ import json
 import os
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
 from docx.shared import Inches, Pt
 from docx.oxml.shared import OxmlElement, qn
 import requests
-import tempfile
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 import re
+import hashlib
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Document formatting shared by every heading and text run
+FONT_NAME = 'Bookman Old Style'
+FONT_SIZE = Pt(12)  # 12 points
+HEADING_SPACE_BEFORE = Inches(0.1389)  # 10/72 inches
+HEADING_SPACE_AFTER = Inches(0.0833)   # 6/72 inches
+PARAGRAPH_SPACE_AFTER = Inches(0.0833)  # 6/72 inches
+BODY_STYLE_NAME = 'Reading Body'
+REFERENCE_STYLE_NAME = 'Reading Reference'
+
+# Image aspect ratios as (width, height) multipliers of the image size in inches
+IMAGE_RATIO_SCALES = {
+    "16:9": (1, 9/16),
+    "4:3": (1, 3/4),
+    "3:4": (3/4, 1),
+    "1:1": (1, 1)
+}
+
+# Bold/italic tags recognised in generated text, captured so split() keeps them
+FORMAT_TAG_RE = re.compile(r'(</?[bi]>)')
+
+# API models and endpoints
+GEMINI_OUTLINE_MODEL = "gemini-2.5-flash"
+GEMINI_IMAGE_MODEL = "gemini-3-pro-image-preview"
+DEEPSEEK_MODEL = "deepseek-reasoner"
+GEMINI_OUTLINE_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_OUTLINE_MODEL}:generateContent"
+DEEPSEEK_CHAT_URL = "https://api.deepseek.com/chat/completions"
+
+# Limits applied to every Gemini/Deepseek API request
+API_TIMEOUT = (3.05, 180)  # (connect, read) timeouts in seconds, so connection failures surface quickly
+MAX_RESPONSE_BYTES = 4_000_000  # Largest response body read into memory
+MAX_IMAGE_WORKERS = 4  # Image generation requests run concurrently
+IMAGE_REQUEST_INTERVAL = 1.0  # Seconds between image request starts, to stay under the API rate limit
+MAX_CHAPTER_WORKERS = 4  # Deepseek chapter requests run concurrently
+
+# Function to read a JSON API response with a bounded body size
+def read_json_response(response, max_bytes=MAX_RESPONSE_BYTES):
+    """
+    Reads a streamed response body in chunks and parses it as JSON.
+    Raises RuntimeError if the body is declared as, or grows past, max_bytes.
+    """
+    # Reject an oversized body up front when the server declares its length
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        response.close()
+        raise RuntimeError(f"API response exceeded {max_bytes} bytes")
+
+    body = bytearray()
+    for chunk in response.iter_content(8192):
+        body += chunk
+        if len(body) > max_bytes:
+            response.close()
+            raise RuntimeError(f"API response exceeded {max_bytes} bytes")
+    return json.loads(body)
 
 # Function to add formatted text to a paragraph
 def add_formatted_text(paragraph, text):
@@ -19,8 +80,8 @@ def add_formatted_text(paragraph, text):
     # Replace HTML entities to handle special characters
     text = text.replace('&lt;', '<').replace('&gt;', '>')
 
-    # Split text by tags while keeping the tags
-    parts = re.split(r'(<b>|</b>|<i>|</i>)', text)
+    # Split text by tags while keeping the tags, in a single pass
+    parts = FORMAT_TAG_RE.split(text)
 
     # Track current formatting state
     bold = False
@@ -37,134 +98,290 @@ def add_formatted_text(paragraph, text):
             italic = False
         elif part:  # Non-empty text content
             run = paragraph.add_run(part)
-            run.font.name = 'Bookman Old Style'
-            run.font.size = Pt(12)  # 12 points
+            run.font.name = FONT_NAME
+            run.font.size = FONT_SIZE
             run.bold = bold
             run.italic = italic
 
+# Function to add a heading with the document's spacing and font
+def add_formatted_heading(doc, text, level=1):
+    """
+    Adds a heading with 10/72 inch spacing before, 6/72 inch spacing after
+    and the document font applied to its runs.
+    """
+    heading = doc.add_heading(text, level=level)
+    heading_format = heading.paragraph_format
+    heading_format.space_before = HEADING_SPACE_BEFORE
+    heading_format.space_after = HEADING_SPACE_AFTER
+    for run in heading.runs:
+        run.font.name = FONT_NAME
+        run.font.size = FONT_SIZE
+    return heading
+
+# Function to register the paragraph styles used for body text and references
+def add_paragraph_styles(doc):
+    """
+    Defines the body and reference paragraph formatting once as document styles,
+    so each paragraph carries a style reference instead of its own formatting.
+    """
+    # Body text: justified, 6/72 after spacing, single line spacing, 0.5 inch first-line indent
+    body_style = doc.styles.add_style(BODY_STYLE_NAME, WD_STYLE_TYPE.PARAGRAPH)
+    body_style.base_style = doc.styles['Normal']
+    body_format = body_style.paragraph_format
+    body_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+    body_format.space_after = PARAGRAPH_SPACE_AFTER
+    body_format.line_spacing = 1.0
+    body_format.first_line_indent = Inches(0.5)
+    body_format.left_indent = 0
+
+    # References: left aligned with the 0.5 inch hanging indent APA style uses
+    reference_style = doc.styles.add_style(REFERENCE_STYLE_NAME, WD_STYLE_TYPE.PARAGRAPH)
+    reference_style.base_style = doc.styles['Normal']
+    reference_format = reference_style.paragraph_format
+    reference_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    reference_format.space_after = PARAGRAPH_SPACE_AFTER
+    reference_format.line_spacing = 1.0
+    reference_format.first_line_indent = Inches(-0.5)
+    reference_format.left_indent = Inches(0.5)
+
+# Function to get a shared Google GenAI client for image generation
+@st.cache_resource
+def get_genai_client(api_key):
+    """
+    Returns a google-genai Client for the API key, shared across images and reruns
+    so its HTTP connection pool is reused. Errors propagate to the caller, since
+    Streamlit does not cache exceptions and a later call can then try again.
+    """
+    # Import the Google GenAI SDK only when an image is actually requested
+    from google import genai
+
+    return genai.Client(api_key=api_key)
+
+# Function to build a limiter that spaces out request starts across threads
+def make_request_pacer(interval):
+    """
+    Returns a callable that blocks until the caller's reserved start slot, so
+    requests made from any number of worker threads begin at least interval
+    seconds apart.
+    """
+    lock = threading.Lock()
+    next_start = [time.monotonic()]
+
+    def wait_for_slot():
+        # Reserve the next free slot under the lock, then sleep outside it
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_start[0])
+            next_start[0] = slot + interval
+        time.sleep(slot - now)
+
+    return wait_for_slot
+
 # Function to generate image from prompt using an image generation API
-def generate_image_from_prompt(prompt, ratio="1:1", size="4", api_key=None):
+def generate_image_from_prompt(prompt, ratio="1:1", client=None, pace=None):
     """
     Generates an image from a prompt using the Gemini 3 Pro Image Preview model via the SDK.
-    This function calls the Google's image generation API to generate the image.
-    Returns the path to the downloaded image file, or None if the API call fails.
+    The ratio is requested in the prompt; the placed size is applied later in the document.
+    This function calls the Google's image generation API through the given client,
+    waiting on pace (if given) immediately before the request starts.
+    Returns the generated image bytes, or None if the API call fails.
     """
-    try:
-        # Import the Google GenAI SDK
-        try:
-            from google import genai
-            from google.genai import types
-            GENAI_AVAILABLE = True
-        except ImportError:
-            print("google-genai not available. Please install it with: pip install google-genai")
-            return None
-
-        # Check if we have a valid API key to call the image generation service
-        if not api_key or not api_key.strip() or "YOUR_" in api_key:
-            print("No valid API key provided for image generation")
-            return None
-
-        # Attempt to call the Gemini 3 Pro Image Preview API with the prompt
-        try:
-            client = genai.Client(api_key=api_key)
-
-            # Map ratio and size to appropriate inch dimensions
-            ratio_map = {
-                "16:9": (size, size * 9/16),  # For 16:9, if width is 'size', height is size * 9/16
-                "4:3": (size, size * 3/4),    # For 4:3, if width is 'size', height is size * 3/4
-                "3:4": (size * 3/4, size),    # For 3:4, if height is 'size', width is size * 3/4
-                "1:1": (size, size)           # For 1:1, both dimensions are 'size'
-            }
-
-            # Get the mapped dimensions
-            width_in, height_in = ratio_map.get(ratio, (4, 4))  # Default to 4x4 if ratio not recognized
-
-            # Enhance prompt with ratio and resolution requirements
-            full_prompt = f"{prompt}. Generate image with {ratio} aspect ratio at 1K resolution. Focus on maintaining the specified aspect ratio."
-
-            # Call the API without the problematic response_mime_type config
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=[full_prompt],
-                # If you need safety settings, add them here, but do NOT add response_mime_type="image/jpeg"
-            )
+    if client is None:
+        print("No image generation client available")
+        return None
 
-            # Check for image data in the response
-            if response.candidates:
-                for candidate in response.candidates:
-                    if hasattr(candidate, 'content') and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            # Check for inline_data (image)
-                            if hasattr(part, 'inline_data') and part.inline_data:
-                                # Create a temporary file
-                                with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                                    temp_file.write(part.inline_data.data)
-                                    print(f"Successfully received and saved image from Gemini 3 Pro Image Preview for prompt: '{prompt[:50]}{'...' if len(prompt) > 50 else ''}'")
-                                    return temp_file.name
-
-            # If no image found, check for text feedback (e.g., safety refusal)
-            if response.candidates and response.candidates[0].content.parts:
-                text_part = response.candidates[0].content.parts[0].text
-                if text_part:
-                    print(f"Model returned text instead of image: {text_part[:100]}...")
-                    return None
-
-            print(f"No image data found in response for prompt: '{prompt}'")
-            return None
+    # Attempt to call the Gemini 3 Pro Image Preview API with the prompt
+    try:
+        # Enhance prompt with ratio and resolution requirements
+        full_prompt = f"{prompt}. Generate image with {ratio} aspect ratio at 1K resolution. Focus on maintaining the specified aspect ratio."
+
+        # Wait for this request's start slot so concurrent requests stay under the rate limit
+        if pace is not None:
+            pace()
+
+        # Call the API without the problematic response_mime_type config
+        response = client.models.generate_content(
+            model=GEMINI_IMAGE_MODEL,
+            contents=[full_prompt],
+            # If you need safety settings, add them here, but do NOT add response_mime_type="image/jpeg"
+        )
 
-        except Exception as e:
-            print(f"SDK Error: {str(e)}")
-            print(f"Failed to generate image for prompt: '{prompt}'")
-            return None
+        # Find the first part carrying inline_data (image), stopping as soon as one is found
+        candidates = response.candidates or []
+        image_part = next(
+            (part
+             for candidate in candidates
+             if candidate.content and candidate.content.parts
+             for part in candidate.content.parts
+             if part.inline_data),
+            None
+        )
+        if image_part is not None:
+            # Keep the image in memory; python-docx can read it from a stream
+            print(f"Successfully received image from Gemini 3 Pro Image Preview for prompt: '{prompt[:50]}{'...' if len(prompt) > 50 else ''}'")
+            return image_part.inline_data.data
+
+        # If no image found, check for text feedback (e.g., safety refusal)
+        if candidates and candidates[0].content and candidates[0].content.parts:
+            text_part = candidates[0].content.parts[0].text
+            if text_part:
+                print(f"Model returned text instead of image: {text_part[:100]}...")
+                return None
+
+        print(f"No image data found in response for prompt: '{prompt}'")
+        return None
 
     except Exception as e:
-        print(f"Error preparing Gemini 3 Pro Image Preview API call: {e}")
+        print(f"SDK Error: {str(e)}")
+        print(f"Failed to generate image for prompt: '{prompt}'")
         return None
 
+# Function to build the cache key for a generated image
+def get_image_key(prompt, ratio):
+    """
+    Returns a stable key for an image request so that topics sharing the same
+    prompt and ratio reuse a single generated image. Size is left out because it
+    only affects how large the image is placed in the document.
+    """
+    return hashlib.sha256(f"{prompt}|{ratio}".encode()).hexdigest()
+
 # Function to add images to a paragraph with square text wrapping
 def add_image_to_doc(doc, image_file, width=None, height=None, position='center'):
     """
     Adds an image to the document with specified positioning and square text wrapping.
+    The image can be raw bytes, an uploaded file-like object, or a path.
     """
-    # Create a temporary file to save the image stream
-    if hasattr(image_file, 'name') and hasattr(image_file, 'getvalue'):
+    # Read the image from memory instead of round-tripping it through a temporary file
+    if isinstance(image_file, bytes):
+        # It's the bytes of a generated image
+        image_stream = BytesIO(image_file)
+    elif hasattr(image_file, 'getvalue'):
         # It's a file-like object from upload
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(image_file.name)[1]) as tmp_img:
-            tmp_img.write(image_file.getvalue())
-            tmp_img_path = tmp_img.name
+        image_stream = BytesIO(image_file.getvalue())
     else:
-        # It's a path to a generated image
-        tmp_img_path = image_file
+        # It's a path to an image file
+        image_stream = image_file
+
+    # Add the image to the document
+    paragraph = doc.add_paragraph()
+
+    # Set alignment based on position
+    if position == 'left':
+        paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    elif position == 'right':
+        paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    else:
+        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER  # Default center
+
+    run = paragraph.add_run()
+    picture = run.add_picture(image_stream, width=width, height=height)
+
+    # Get the picture element to modify its properties for square text wrapping
+    pic = picture._inline
+    # Set the distance from text - this affects the square wrapping appearance
+    pic.dist_t = 0  # Distance from top
+    pic.dist_b = 0  # Distance from bottom
+    pic.dist_l = 114300  # Distance from left (in EMUs - 114300 EMUs = 0.1 inch)
+    pic.dist_r = 114300  # Distance from right (in EMUs - 114300 EMUs = 0.1 inch)
 
+    # Add some spacing after the image
+    paragraph.paragraph_format.space_after = PARAGRAPH_SPACE_AFTER
+
+# Function to add a generated topic image sized by its aspect ratio
+def add_topic_image(doc, image, ratio, size):
+    """
+    Adds a topic image whose dimensions come from its ratio and size in inches,
+    placed on the left or right at random for variety. Unknown ratios are square.
+    """
+    width_scale, height_scale = IMAGE_RATIO_SCALES.get(ratio, (1, 1))
+    position = random.choice(['left', 'right'])
+    add_image_to_doc(doc, image,
+                     width=Inches(size * width_scale), height=Inches(size * height_scale),
+                     position=position)
+
+# Function to get a shared HTTP session for the Gemini and Deepseek APIs
+@st.cache_resource
+def get_http_session():
+    """
+    Returns a requests Session shared across reruns so that repeated API calls
+    reuse the same keep-alive TCP/TLS connection instead of opening a new one.
+    """
+    # Retry rate limits and transient server errors with exponential backoff, honouring Retry-After.
+    # Read timeouts are not retried so a stalled generation is not sent again, and the final
+    # response is returned instead of raised so the caller reports its status code.
+    retries = Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CHAPTER_WORKERS, max_retries=retries))
+    # Both APIs take JSON bodies, so send the content type on every request
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+# Function to generate the reading material for one chapter with Deepseek
+def generate_chapter_material(session, chapter_name, prompt, api_key, temperature):
+    """
+    Sends a chapter prompt to the Deepseek Reasoner API and parses the returned material.
+    Returns a (material_data, kind, message) tuple where material_data is None on failure
+    and kind/message describe the outcome for the generation log. It does not call
+    Streamlit, so it can run in a worker thread.
+    """
     try:
-        # Add the image to the document
-        paragraph = doc.add_paragraph()
-
-        # Set alignment based on position
-        if position == 'left':
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-        elif position == 'right':
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-        else:
-            paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER  # Default center
-
-        run = paragraph.add_run()
-        picture = run.add_picture(tmp_img_path, width=width, height=height)
-
-        # Get the picture element to modify its properties for square text wrapping
-        pic = picture._inline
-        # Set the distance from text - this affects the square wrapping appearance
-        pic.dist_t = 0  # Distance from top
-        pic.dist_b = 0  # Distance from bottom
-        pic.dist_l = 114300  # Distance from left (in EMUs - 114300 EMUs = 0.1 inch)
-        pic.dist_r = 114300  # Distance from right (in EMUs - 114300 EMUs = 0.1 inch)
-
-        # Add some spacing after the image
-        paragraph.paragraph_format.space_after = Inches(0.0833)  # 6/72 inches
-    finally:
-        # Clean up the temporary image file if it was created
-        if hasattr(image_file, 'name') and hasattr(image_file, 'getvalue'):
-            os.unlink(tmp_img_path)
+        # Call Deepseek API to generate content
+        headers = {
+            "Authorization": f"Bearer {api_key}"
+        }
+
+        response = session.post(
+            DEEPSEEK_CHAT_URL,
+            headers=headers,
+            json={
+                "model": DEEPSEEK_MODEL,
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ],
+                "temperature": temperature,
+                "max_tokens": 16000,  # Set token limit to 16k
+                "response_format": {"type": "json_object"}
+            },
+            stream=True,
+            timeout=API_TIMEOUT
+        )
+
+        if response.status_code == 200:
+            result = read_json_response(response)
+            content = result['choices'][0]['message']['content']
+
+            # Extract JSON from response
+            json_match = re.search(r'\{.*\}', content, re.DOTALL)
+
+            if json_match:
+                json_str = json_match.group()
+                material_data = json.loads(json_str)
+                return material_data, "success", f"✓ Generated material for: {chapter_name}"
+            return None, "warning", f"Could not extract JSON for {chapter_name}"
+        return None, "error", f"Deepseek API error for {chapter_name}: {response.status_code} - {response.text}"
+
+    except requests.exceptions.RequestException as e:
+        return None, "error", f"Network error while generating material for {chapter_name}: {str(e)}"
+    except json.JSONDecodeError:
+        return None, "error", f"Invalid JSON response from Deepseek API for {chapter_name}"
+    except Exception as e:
+        return None, "error", f"Unexpected error while generating material for {chapter_name}: {str(e)}"
+
+# Function to load API keys from an uploaded keys file
+def load_api_keys(keys_bytes):
+    """
+    Parses an API keys JSON file into a mapping of API name to its first key.
+    """
+    keys_data = json.loads(keys_bytes)
+    return {api['name']: api['keys'][0] for api in keys_data['apis']}
 
 # Set page config
 st.set_page_config(
@@ -189,11 +406,9 @@ if 'generated_materials' not in st.session_state:
 if 'processing_status' not in st.session_state:
     st.session_state.processing_status = ""
 if 'generated_docs' not in st.session_state:
-    st.session_state.generated_docs = {}  # Cache generated documents
+    st.session_state.generated_docs = {}  # Cache generated documents as (content hash, DOCX bytes)
 if 'image_cache' not in st.session_state:
-    st.session_state.image_cache = {}  # Cache generated images
-if 'generation_complete' not in st.session_state:
-    st.session_state.generation_complete = False  # Flag to indicate generation is done
+    st.session_state.image_cache = {}  # Cache generated image bytes keyed by prompt/ratio hash
 if 'json_file_uploaded' not in st.session_state:
     st.session_state.json_file_uploaded = False  # Flag to indicate if JSON file was uploaded
 if 'full_materials_json' not in st.session_state:
@@ -202,6 +417,8 @@ if 'image_prompts_txt' not in st.session_state:
     st.session_state.image_prompts_txt = None  # Stores image prompts text for download
 if 'original_filename' not in st.session_state:
     st.session_state.original_filename = None  # Stores original uploaded filename
+if 'api_keys' not in st.session_state:
+    st.session_state.api_keys = None  # Parsed API keys as (file hash, keys), kept only for this session
 
 # Sidebar for API keys
 with st.sidebar:
@@ -212,8 +429,12 @@ with st.sidebar:
 
     if uploaded_keys:
         try:
-            keys_data = json.load(uploaded_keys)
-            apis = {api['name']: api['keys'][0] for api in keys_data['apis']}
+            # Re-parse the keys file only when a different file is uploaded in this session
+            keys_bytes = uploaded_keys.getvalue()
+            keys_hash = hashlib.sha256(keys_bytes).hexdigest()
+            if st.session_state.api_keys is None or st.session_state.api_keys[0] != keys_hash:
+                st.session_state.api_keys = (keys_hash, load_api_keys(keys_bytes))
+            apis = st.session_state.api_keys[1]
             gemini_api_key = apis.get('gemini', '')
             nano_banana_gemini_api_key = apis.get('nano_banana_gemini', '')
             deepseek_api_key = apis.get('deepseek', '')
@@ -319,10 +540,6 @@ with tab1:
 
                     # Call Gemini API to extract chapters and topics
                     try:
-                        headers = {
-                            "Content-Type": "application/json"
-                        }
-
                         # Prepare the prompt for Gemini
                         prompt = f"""
                         Analyze the following course outline and extract chapters and topics in JSON format.
@@ -345,24 +562,23 @@ with tab1:
                         api_key_to_use = gemini_api_key
 
                         # Make request to Gemini API
-                        # For Gemini API, the key should be passed as a query parameter or in the URL
-                        import urllib.parse
-                        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={urllib.parse.quote(api_key_to_use)}"
-
-                        response = requests.post(
-                            url,
-                            headers={"Content-Type": "application/json"},
+                        # The key goes in the x-goog-api-key header so it stays out of the URL and any logs of it
+                        response = get_http_session().post(
+                            GEMINI_OUTLINE_URL,
+                            headers={"x-goog-api-key": api_key_to_use},
                             json={
                                 "contents": [{
                                     "parts": [{
                                         "text": prompt
                                     }]
                                 }]
-                            }
+                            },
+                            stream=True,
+                            timeout=API_TIMEOUT
                         )
 
                         if response.status_code == 200:
-                            result = response.json()
+                            result = read_json_response(response)
 
                             # Extract the text response
                             text_response = result['candidates'][0]['content']['parts'][0]['text']
@@ -519,39 +735,32 @@ if st.session_state.chapters_data:
         if not deepseek_api_key and not using_complete_materials:
             st.error("Please enter your Deepseek API key in the sidebar")
         else:
-            # Clean up previously cached documents and reset flags
-            for doc_path in st.session_state.generated_docs.values():
-                try:
-                    os.unlink(doc_path)
-                except:
-                    pass  # Ignore errors if file doesn't exist
-
-            # Clean up cached images
-            for img_path in st.session_state.image_cache.values():
-                try:
-                    os.unlink(img_path)
-                except:
-                    pass  # Ignore errors if file doesn't exist
-
             # Reset session state for new generation
             st.session_state.generated_docs = {}
             st.session_state.image_cache = {}
-            st.session_state.generation_complete = False
 
             # Create a progress bar
             progress_bar = st.progress(0)
             status_text = st.empty()
 
             with st.spinner("Generating materials with Deepseek..."):
-                # Process each selected chapter with Deepseek
-                generated_materials = {}
+                # Outcome of each selected chapter as (material_data, kind, message)
+                chapter_results = {}
+                # Prompts for the chapters that still need a Deepseek call
+                chapter_prompts = {}
 
-                for idx, chapter_data in enumerate(selected_chapters):
+                for chapter_data in selected_chapters:
                     chapter_name = chapter_data["chapter"]
                     topics = chapter_data["topics"]
 
-                    status_text.text(f"Processing: {chapter_name}...")
-                    progress_bar.progress((idx + 1) / len(selected_chapters))
+                    # If we have complete material data for this chapter, use it directly and skip the prompt
+                    if using_complete_materials and chapter_name in st.session_state.full_materials_json:
+                        chapter_results[chapter_name] = (
+                            st.session_state.full_materials_json[chapter_name],
+                            "success",
+                            f"✓ Loaded material for: {chapter_name} from JSON file"
+                        )
+                        continue
 
                     # Prepare prompt for Deepseek Reasoner
                     base_prompt = f"""
@@ -607,7 +816,6 @@ if st.session_state.chapters_data:
                     # If image generation is enabled, modify the prompt to include image generation
                     if enable_image_generation or save_prompts_to_txt:
                         # Select the specified number of topics for image generation based on which toggle is enabled
-                        import random
                         if enable_image_generation:
                             num_images_to_generate = min(num_images_per_chapter, len(topics))
                         else:
@@ -643,65 +851,41 @@ if st.session_state.chapters_data:
                     else:
                         prompt = base_prompt
 
-                    try:
-                        # Check if we're using a JSON file that contains complete materials (not just outline)
-                        using_complete_materials = (
-                            st.session_state.json_file_uploaded and
-                            hasattr(st.session_state, 'full_materials_json') and
-                            st.session_state.full_materials_json is not None and
-                            chapter_name in st.session_state.full_materials_json
-                        )
+                    chapter_prompts[chapter_name] = prompt
 
-                        # If we have complete material data for this chapter, use it directly
-                        if using_complete_materials:
-                            material_data = st.session_state.full_materials_json[chapter_name]
-                            generated_materials[chapter_name] = material_data
-                            st.success(f"✓ Loaded material for: {chapter_name} from JSON file")
-                        else:
-                            # Call Deepseek API to generate content
-                            headers = {
-                                "Content-Type": "application/json",
-                                "Authorization": f"Bearer {deepseek_api_key}"
-                            }
-
-                            response = requests.post(
-                                "https://api.deepseek.com/chat/completions",
-                                headers=headers,
-                                json={
-                                    "model": "deepseek-reasoner",
-                                    "messages": [
-                                        {"role": "user", "content": prompt}
-                                    ],
-                                    "temperature": deepseek_temperature,
-                                    "max_tokens": 16000,  # Set token limit to 16k
-                                    "response_format": {"type": "json_object"}
-                                }
-                            )
-
-                            if response.status_code == 200:
-                                result = response.json()
-                                content = result['choices'][0]['message']['content']
-
-                                # Extract JSON from response
-                                import re
-                                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-
-                                if json_match:
-                                    json_str = json_match.group()
-                                    material_data = json.loads(json_str)
-                                    generated_materials[chapter_name] = material_data
-                                    st.success(f"✓ Generated material for: {chapter_name}")
-                                else:
-                                    st.warning(f"Could not extract JSON for {chapter_name}")
-                            else:
-                                st.error(f"Deepseek API error for {chapter_name}: {response.status_code} - {response.text}")
+                progress_bar.progress(len(chapter_results) / len(selected_chapters))
 
-                    except requests.exceptions.RequestException as e:
-                        st.error(f"Network error while generating material for {chapter_name}: {str(e)}")
-                    except json.JSONDecodeError:
-                        st.error(f"Invalid JSON response from Deepseek API for {chapter_name}")
-                    except Exception as e:
-                        st.error(f"Unexpected error while generating material for {chapter_name}: {str(e)}")
+                # Call Deepseek for the remaining chapters concurrently, since each call mostly waits on the network
+                if chapter_prompts:
+                    status_text.text(f"Processing {len(chapter_prompts)} chapter(s)...")
+                    session = get_http_session()
+                    with ThreadPoolExecutor(max_workers=min(MAX_CHAPTER_WORKERS, len(chapter_prompts))) as executor:
+                        futures = {
+                            executor.submit(generate_chapter_material, session, chapter_name, prompt, deepseek_api_key, deepseek_temperature): chapter_name
+                            for chapter_name, prompt in chapter_prompts.items()
+                        }
+                        for future in as_completed(futures):
+                            chapter_name = futures[future]
+                            chapter_results[chapter_name] = future.result()
+                            status_text.text(f"Finished: {chapter_name}")
+                            progress_bar.progress(len(chapter_results) / len(selected_chapters))
+
+                # Keep materials and status messages in the order the chapters were selected
+                generated_materials = {}
+                log_messages = []
+                for chapter_data in selected_chapters:
+                    chapter_name = chapter_data["chapter"]
+                    material_data, kind, message = chapter_results[chapter_name]
+                    if material_data is not None:
+                        generated_materials[chapter_name] = material_data
+                    log_messages.append((kind, message))
+
+                # Render the per-chapter status messages in a single block, opened when any chapter was lost
+                failed_chapter_count = sum(1 for kind, _ in log_messages if kind != "success")
+                if log_messages:
+                    with st.expander("Generation log", expanded=failed_chapter_count > 0):
+                        for kind, message in log_messages:
+                            getattr(st, kind)(message)
 
                 # If save_prompts_to_txt is enabled, save image prompts to a text file with the same name as the generated DOCX files
                 if save_prompts_to_txt and generated_materials:
@@ -722,13 +906,13 @@ if st.session_state.chapters_data:
 
                     txt_filename = f"{base_filename}_image_prompts.txt"
 
-                    # Collect all image prompts
-                    all_prompts = []
-                    for chapter_name, content in generated_materials.items():
-                        for topic in content.get("topics", []):
-                            image_prompt = topic.get("image_prompt")
-                            if image_prompt:
-                                all_prompts.append(f"Chapter: {chapter_name}\nTopic: {topic.get('topic', 'N/A')}\nPrompt: {image_prompt}\n---\n")
+                    # Collect all image prompts in a single pass
+                    all_prompts = [
+                        f"Chapter: {chapter_name}\nTopic: {topic.get('topic', 'N/A')}\nPrompt: {image_prompt}\n---\n"
+                        for chapter_name, content in generated_materials.items()
+                        for topic in content.get("topics", [])
+                        if (image_prompt := topic.get("image_prompt"))
+                    ]
 
                     # Create the text content
                     txt_content = "Generated Image Prompts:\n\n" + "\n".join(all_prompts)
@@ -746,7 +930,10 @@ if st.session_state.chapters_data:
                 st.session_state.generated_materials = generated_materials
 
                 if generated_materials:
-                    st.success("All reading materials generated successfully!")
+                    if failed_chapter_count:
+                        st.warning(f"{failed_chapter_count} of {len(log_messages)} chapters could not be generated. See the generation log for details.")
+                    else:
+                        st.success("All reading materials generated successfully!")
 
                     # Add a button to save the generated materials as JSON
                     if st.button("Save Generated Materials as JSON"):
@@ -772,240 +959,168 @@ if st.session_state.chapters_data:
 if st.session_state.generated_materials:
     st.markdown("### Step 3: Download Generated Materials")
 
-    # Check if documents are already cached
-    if not st.session_state.generated_docs or not st.session_state.generation_complete:
-        # Generate documents and cache them
-        for chapter_name, content in st.session_state.generated_materials.items():
-            # Check if document is already cached
-            if chapter_name not in st.session_state.generated_docs:
-                # Create DOCX file
-                doc = Document()
-                title_heading = doc.add_heading(content.get("title", chapter_name), 0)
-                # Format the main title heading with 10/72 before line spacing and 6/72 after line spacing
-                title_heading.paragraph_format.space_before = Inches(0.1389)  # 10/72 inches
-                title_heading.paragraph_format.space_after = Inches(0.0833)   # 6/72 inches
-                # Apply Bookman Old Style font to title
-                for run in title_heading.runs:
-                    run.font.name = 'Bookman Old Style'
-                    run.font.size = Pt(12)  # 12 points
-
-                # Add chapter introduction if available
-                introduction = content.get("introduction")
-                if introduction:
-                    intro_heading = doc.add_heading("Chapter Introduction", level=1)
-                    # Format the heading with 10/72 before line spacing and 6/72 after line spacing
-                    intro_heading.paragraph_format.space_before = Inches(0.1389)  # 10/72 inches
-                    intro_heading.paragraph_format.space_after = Inches(0.0833)   # 6/72 inches
-                    # Apply Bookman Old Style font to heading
-                    for run in intro_heading.runs:
-                        run.font.name = 'Bookman Old Style'
-                        run.font.size = Pt(12)  # 12 points
-
-                    # Process introduction with formatting
-                    intro_para = doc.add_paragraph()
-                    # Format the paragraph: justified, 6/72 line spacing, 1 tab indent
-                    intro_para.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                    intro_para_format = intro_para.paragraph_format
-                    intro_para_format.space_after = Inches(0.0833)  # 6/72 inches after paragraph
-                    intro_para_format.line_spacing = 1.0  # Single line spacing
-                    intro_para_format.first_line_indent = Inches(0.5)  # 0.5 inch indent
-                    # Also set left indent to make it more visible
-                    intro_para_format.left_indent = 0  # Keep left margin at 0
-
-                    # Add formatted text to the paragraph
-                    add_formatted_text(intro_para, introduction)
-
-                for topic in content.get("topics", []):
-                    # Add topic heading with 10pt before spacing and 6pt after spacing
-                    topic_heading = doc.add_heading(topic.get("topic", "Topic"), level=1)
-                    topic_heading.paragraph_format.space_before = Inches(0.1389)  # Approximately 10pt (10/72 inches)
-                    topic_heading.paragraph_format.space_after = Inches(0.0833)   # Approximately 6pt (6/72 inches)
-                    # Apply Bookman Old Style font to heading
-                    for run in topic_heading.runs:
-                        run.font.name = 'Bookman Old Style'
-                        run.font.size = Pt(12)  # 12 points
-
-                    # Handle both single content string and multiple content sections
-                    topic_content = topic.get("content", "")
-
-                    # Check if this topic has an image prompt and if image generation is enabled
-                    image_prompt = topic.get("image_prompt")
-                    image_ratio = topic.get("ratio", "1:1")  # Default to square if no ratio specified
-                    image_size = float(topic.get("size", "4"))  # Default to 4 inches if no size specified
-                    image_generated = None
+    # Work out which chapters need their documents (re)built because their content changed
+    stale_chapters = {}
+    for chapter_name, content in st.session_state.generated_materials.items():
+        # Hash the chapter content together with the image toggle, since both shape the document
+        content_hash = hashlib.sha256(
+            json.dumps([content, enable_image_generation], sort_keys=True).encode()
+        ).hexdigest()
 
-                    # Only generate images if the nano banana image generation toggle is enabled
-                    if enable_image_generation and image_prompt:
-                        # Create a unique key for this image based on the prompt
-                        image_key = hash(image_prompt)
+        cached_doc = st.session_state.generated_docs.get(chapter_name)
+        if cached_doc is None or cached_doc[0] != content_hash:
+            stale_chapters[chapter_name] = content_hash
 
-                        # Check if image is already cached
-                        if image_key in st.session_state.image_cache:
-                            image_generated = st.session_state.image_cache[image_key]
-                        else:
-                            # Generate image from prompt using Nano Banana Pro Gemini API with ratio and size
-                            image_generated = generate_image_from_prompt(image_prompt, image_ratio, image_size, nano_banana_gemini_api_key)
-                            # Cache the generated image path
-                            if image_generated:
-                                st.session_state.image_cache[image_key] = image_generated
-
-                    if isinstance(topic_content, list):
-                        # Multiple content sections
-                        paragraph_count = 0
-                        for content_section_idx, content_section in enumerate(topic_content):
-                            para = doc.add_paragraph()
-                            # Format the paragraph: justified, 6/72 after spacing, 1 tab indent
-                            para.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                            para_format = para.paragraph_format
-                            para_format.space_after = Inches(0.0833)  # 6/72 inches after paragraph
-                            para_format.line_spacing = 1.0  # Single line spacing
-                            para_format.first_line_indent = Inches(0.5)  # 0.5 inch indent
-                            # Also set left indent to make it more visible
-                            para_format.left_indent = 0  # Keep left margin at 0
-
-                            # Add formatted text to the paragraph
-                            add_formatted_text(para, content_section)
-
-                            # Add image after the second paragraph if image generation is enabled and image exists
-                            paragraph_count += 1
-                            if (enable_image_generation and image_generated and
-                                paragraph_count == 2):  # After the second paragraph
-                                # Determine position (left or right) randomly for variety
-                                import random
-                                position = random.choice(['left', 'right'])
-                                # Use standardized dimensions based on the ratio and size from the topic
-                                ratio = topic.get("ratio", "1:1")
-                                size = float(topic.get("size", "4"))
-
-                                # Calculate dimensions based on ratio
-                                if ratio == "16:9":
-                                    width_in, height_in = size, size * 9/16
-                                elif ratio == "4:3":
-                                    width_in, height_in = size, size * 3/4
-                                elif ratio == "3:4":
-                                    width_in, height_in = size * 3/4, size
-                                elif ratio == "1:1":  # Square
-                                    width_in, height_in = size, size
-                                else:  # Default to square
-                                    width_in, height_in = size, size
-
-                                # Add image with standardized dimensions based on ratio, random placement
-                                add_image_to_doc(doc, image_generated,
-                                               width=Inches(width_in), height=Inches(height_in),
-                                               position=position)
-                    else:
-                        # Single content string
-                        para = doc.add_paragraph()
-                        # Format the paragraph: justified, 6/72 after spacing, 1 tab indent
-                        para.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                        para_format = para.paragraph_format
-                        para_format.space_after = Inches(0.0833)  # 6/72 inches after paragraph
-                        para_format.line_spacing = 1.0  # Single line spacing
-                        para_format.first_line_indent = Inches(0.5)  # 0.5 inch indent
-
-                        # Add formatted text to the paragraph
-                        add_formatted_text(para, topic_content)
-
-                        # If there's only one paragraph and we have an image, add it after
-                        if enable_image_generation and image_generated:
-                            # Determine position (left or right) randomly for variety
-                            import random
-                            position = random.choice(['left', 'right'])
-                            # Use standardized dimensions based on the ratio and size from the topic
-                            ratio = topic.get("ratio", "1:1")
-                            size = float(topic.get("size", "4"))
-
-                            # Calculate dimensions based on ratio
-                            if ratio == "16:9":
-                                width_in, height_in = size, size * 9/16
-                            elif ratio == "4:3":
-                                width_in, height_in = size, size * 3/4
-                            elif ratio == "3:4":
-                                width_in, height_in = size * 3/4, size
-                            elif ratio == "1:1":  # Square
-                                width_in, height_in = size, size
-                            else:  # Default to square
-                                width_in, height_in = size, size
-
-                            # Add image with standardized dimensions based on ratio, random placement
-                            add_image_to_doc(doc, image_generated,
-                                           width=Inches(width_in), height=Inches(height_in),
-                                           position=position)
-
-                # Add Summary section
-                summary = content.get("summary")
-                if summary:
-                    summary_heading = doc.add_heading("Summary", level=1)
-                    summary_heading.paragraph_format.space_before = Inches(0.1389)  # Approximately 10pt (10/72 inches)
-                    summary_heading.paragraph_format.space_after = Inches(0.0833)   # Approximately 6pt (6/72 inches)
-                    # Apply Bookman Old Style font to heading
-                    for run in summary_heading.runs:
-                        run.font.name = 'Bookman Old Style'
-                        run.font.size = Pt(12)  # 12 points
-
-                    summary_para = doc.add_paragraph()
-                    # Format the paragraph: justified, 6/72 after spacing, 1 tab indent
-                    summary_para.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                    summary_para_format = summary_para.paragraph_format
-                    summary_para_format.space_after = Inches(0.0833)  # 6/72 inches after paragraph
-                    summary_para_format.line_spacing = 1.0  # Single line spacing
-                    summary_para_format.first_line_indent = Inches(0.5)  # 0.5 inch indent
+    # Only generate images if the nano banana image generation toggle is enabled
+    if enable_image_generation:
+        # Group image prompts across chapters so each unique prompt/ratio is generated once
+        unique_image_jobs = {}
+        for chapter_name in stale_chapters:
+            for topic in st.session_state.generated_materials[chapter_name].get("topics", []):
+                image_prompt = topic.get("image_prompt")
+                if image_prompt:
+                    image_ratio = topic.get("ratio", "1:1")  # Default to square if no ratio specified
+                    image_key = get_image_key(image_prompt, image_ratio)
+                    if image_key not in st.session_state.image_cache:
+                        unique_image_jobs[image_key] = (image_prompt, image_ratio)
+
+        # Share one client across all image requests; it is created here because workers have no Streamlit context
+        image_client = None
+        if unique_image_jobs:
+            # Check if we have a valid API key to call the image generation service
+            if not nano_banana_gemini_api_key or not nano_banana_gemini_api_key.strip() or "YOUR_" in nano_banana_gemini_api_key:
+                print("No valid API key provided for image generation")
+            else:
+                try:
+                    image_client = get_genai_client(nano_banana_gemini_api_key)
+                except ImportError:
+                    print("google-genai not available. Please install it with: pip install google-genai")
+                except Exception as e:
+                    print(f"Error preparing Gemini 3 Pro Image Preview API client: {e}")
+
+        if image_client is not None:
+            # Generate images from prompts using Nano Banana Pro Gemini API concurrently, since each call waits on the network
+            # Workers pace their own request starts, so queued jobs cannot burst when a worker frees up
+            image_pace = make_request_pacer(IMAGE_REQUEST_INTERVAL)
+            with ThreadPoolExecutor(max_workers=min(MAX_IMAGE_WORKERS, len(unique_image_jobs))) as executor:
+                futures = {
+                    executor.submit(generate_image_from_prompt, image_prompt, image_ratio, image_client, image_pace): image_key
+                    for image_key, (image_prompt, image_ratio) in unique_image_jobs.items()
+                }
+                for future in as_completed(futures):
+                    image_generated = future.result()
+                    # Cache the generated image bytes
+                    if image_generated:
+                        st.session_state.image_cache[futures[future]] = image_generated
+
+    # Build documents for the chapters whose content changed
+    for chapter_name, content_hash in stale_chapters.items():
+        content = st.session_state.generated_materials[chapter_name]
+
+        # Create DOCX file
+        doc = Document()
+        add_paragraph_styles(doc)
+        add_formatted_heading(doc, content.get("title", chapter_name), level=0)
+
+        # Add chapter introduction if available
+        introduction = content.get("introduction")
+        if introduction:
+            add_formatted_heading(doc, "Chapter Introduction")
+
+            # Process introduction with formatting
+            intro_para = doc.add_paragraph(style=BODY_STYLE_NAME)
+
+            # Add formatted text to the paragraph
+            add_formatted_text(intro_para, introduction)
+
+        for topic in content.get("topics", []):
+            # Add topic heading
+            add_formatted_heading(doc, topic.get("topic", "Topic"))
+
+            # Handle both single content string and multiple content sections
+            topic_content = topic.get("content", "")
+
+            # Check if this topic has an image prompt and if image generation is enabled
+            image_prompt = topic.get("image_prompt")
+            image_ratio = topic.get("ratio", "1:1")  # Default to square if no ratio specified
+            image_size = float(topic.get("size", "4"))  # Default to 4 inches if no size specified
+            image_generated = None
+
+            # Look up the image generated for this prompt and ratio
+            if enable_image_generation and image_prompt:
+                image_generated = st.session_state.image_cache.get(get_image_key(image_prompt, image_ratio))
+
+            if isinstance(topic_content, list):
+                # Multiple content sections
+                paragraph_count = 0
+                for content_section_idx, content_section in enumerate(topic_content):
+                    para = doc.add_paragraph(style=BODY_STYLE_NAME)
 
                     # Add formatted text to the paragraph
-                    add_formatted_text(summary_para, summary)
-
-                # Add References section
-                references = content.get("references", [])
-                if references:
-                    references_heading = doc.add_heading("References", level=1)
-                    references_heading.paragraph_format.space_before = Inches(0.1389)  # Approximately 10pt (10/72 inches)
-                    references_heading.paragraph_format.space_after = Inches(0.0833)   # Approximately 6pt (6/72 inches)
-                    # Apply Bookman Old Style font to heading
-                    for run in references_heading.runs:
-                        run.font.name = 'Bookman Old Style'
-                        run.font.size = Pt(12)  # 12 points
-
-                    for reference in references:
-                        ref_para = doc.add_paragraph()
-                        # Format the paragraph: justified, 6/72 after spacing, hanging indent of 0.5 inches
-                        ref_para.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                        ref_para_format = ref_para.paragraph_format
-                        ref_para_format.space_after = Inches(0.0833)  # 6/72 inches after paragraph
-                        ref_para_format.line_spacing = 1.0  # Single line spacing
-                        # APA style uses a hanging indent of 0.5 inches
-                        ref_para_format.first_line_indent = Inches(-0.5)
-                        ref_para_format.left_indent = Inches(0.5)
-
-                        # Format reference according to APA 7th edition
-                        author = reference.get("author", "")
-                        year = reference.get("year", "")
-                        title = reference.get("title", "")
-                        publisher = reference.get("publisher", "")
-                        url = reference.get("url", "")
-
-                        # Construct APA 7th edition reference
-                        apa_reference = ""
-                        if author:
-                            apa_reference += f"{author}. "
-                        if year:
-                            apa_reference += f"({year}). "
-                        if title:
-                            apa_reference += f"<i>{title}</i>. "
-                        if publisher:
-                            apa_reference += f"{publisher}."
-                        if url:
-                            apa_reference += f" {url}"
-
-                        # Add formatted text to the paragraph
-                        add_formatted_text(ref_para, apa_reference)
-
-                # Save to temporary file and cache it
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp_file:
-                    doc.save(tmp_file.name)
-                    st.session_state.generated_docs[chapter_name] = tmp_file.name  # Cache the file path
-
-        # Mark generation as complete to prevent regeneration on rerun
-        st.session_state.generation_complete = True
+                    add_formatted_text(para, content_section)
+
+                    # Add image after the second paragraph if image generation is enabled and image exists
+                    paragraph_count += 1
+                    if (enable_image_generation and image_generated and
+                        paragraph_count == 2):  # After the second paragraph
+                        add_topic_image(doc, image_generated, image_ratio, image_size)
+            else:
+                # Single content string
+                para = doc.add_paragraph(style=BODY_STYLE_NAME)
+
+                # Add formatted text to the paragraph
+                add_formatted_text(para, topic_content)
+
+                # If there's only one paragraph and we have an image, add it after
+                if enable_image_generation and image_generated:
+                    add_topic_image(doc, image_generated, image_ratio, image_size)
+
+        # Add Summary section
+        summary = content.get("summary")
+        if summary:
+            add_formatted_heading(doc, "Summary")
+
+            summary_para = doc.add_paragraph(style=BODY_STYLE_NAME)
+
+            # Add formatted text to the paragraph
+            add_formatted_text(summary_para, summary)
+
+        # Add References section
+        references = content.get("references", [])
+        if references:
+            add_formatted_heading(doc, "References")
+
+            for reference in references:
+                ref_para = doc.add_paragraph(style=REFERENCE_STYLE_NAME)
+
+                # Format reference according to APA 7th edition
+                author = reference.get("author", "")
+                year = reference.get("year", "")
+                title = reference.get("title", "")
+                publisher = reference.get("publisher", "")
+                url = reference.get("url", "")
+
+                # Construct APA 7th edition reference from the fields that are present
+                apa_parts = []
+                if author:
+                    apa_parts.append(f"{author}.")
+                if year:
+                    apa_parts.append(f"({year}).")
+                if title:
+                    apa_parts.append(f"<i>{title}</i>.")
+                if publisher:
+                    apa_parts.append(f"{publisher}.")
+                if url:
+                    apa_parts.append(url)
+                apa_reference = " ".join(apa_parts)
+
+                # Add formatted text to the paragraph
+                add_formatted_text(ref_para, apa_reference)
+
+        # Save to an in-memory buffer and cache the bytes with the content hash
+        docx_buffer = BytesIO()
+        doc.save(docx_buffer)
+        st.session_state.generated_docs[chapter_name] = (content_hash, docx_buffer.getvalue())
 
     # Display download buttons for cached documents
     for chapter_name in st.session_state.generated_materials.keys():
@@ -1013,14 +1128,13 @@ if st.session_state.generated_materials:
 
         if chapter_name in st.session_state.generated_docs:
             # Provide download button for cached document
-            with open(st.session_state.generated_docs[chapter_name], "rb") as f:
-                st.download_button(
-                    label=f"Download {chapter_name}.docx",
-                    data=f.read(),
-                    file_name=f"{chapter_name.replace(' ', '_')}.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    key=f"download_{chapter_name}"  # Unique key to prevent conflicts
-                )
+            st.download_button(
+                label=f"Download {chapter_name}.docx",
+                data=st.session_state.generated_docs[chapter_name][1],
+                file_name=f"{chapter_name.replace(' ', '_')}.docx",
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                key=f"download_{chapter_name}"  # Unique key to prevent conflicts
+            )
 
     # Show download button for image prompts if they were generated
     if st.session_state.image_prompts_txt: